@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+#
+# High volume randomized conformance test of the ALU against a NumPy reference model.
+#
+# Stimulus is generated in batches, run through a CXXRTL build of the ALU (or pysim for
+# comparison) and checked against the vectorized model. The compiled simulator is kept
+# in the netlist.py cache, keyed on the ALU width, the sources, the amaranth and yosys
+# versions and the C++ compiler.
+#
+import os
+import sys
+import time
+import hashlib
+import argparse
+import subprocess
+import tempfile
+from importlib import metadata
+
+import numpy as np
+
+from amaranth import *
+from amaranth.back import rtlil
+
+from cpu import ALU, Op
+from netlist import HERE, add_cache_arguments, cache_from_args, find_yosys, yosys_version, yosys_convert
+
+u64 = np.uint64
+
+# The ALU needs at least 16 bits for SR16, the model and the C++ driver hold values in 64 bits.
+MIN_WIDTH = 16
+MAX_WIDTH = 64
+
+# Stimulus and response records exchanged with the compiled simulator
+VECTOR = np.dtype([("a", "<u8"), ("b", "<u8"), ("op", "u1"), ("c_in", "u1")])
+RESPONSE = np.dtype([("result", "<u8"), ("flags", "u1")]) # flags: z, c, n
+
+DRIVER = """
+#include <cstdio>
+#include <cstdint>
+#include <vector>
+#include "alu.cc"
+
+struct __attribute__((packed)) vector_t { uint64_t a, b; uint8_t op, c_in; };
+struct __attribute__((packed)) response_t { uint64_t result; uint8_t flags; };
+
+int main(int argc, char **argv)
+{
+	cxxrtl_design::p_top top;
+	std::vector<vector_t> v(1 << 16);
+	std::vector<response_t> r(1 << 16);
+	FILE *in = fopen(argv[1], "rb");
+	FILE *out = fopen(argv[2], "wb");
+	size_t n;
+	if (!in || !out)
+		return 1;
+	while ((n = fread(v.data(), sizeof(vector_t), v.size(), in)) > 0) {
+		for (size_t i = 0; i < n; i++) {
+			top.p_a.set<uint64_t>(v[i].a);
+			top.p_b.set<uint64_t>(v[i].b);
+			top.p_op.set<uint8_t>(v[i].op);
+			top.p_cin.set<uint8_t>(v[i].c_in);
+			top.step();
+			r[i].result = top.p_result.get<uint64_t>();
+			r[i].flags = top.p_z.get<uint8_t>() | (top.p_c.get<uint8_t>() << 1) | (top.p_n.get<uint8_t>() << 2);
+		}
+		fwrite(r.data(), sizeof(response_t), n, out);
+	}
+	fclose(out);
+	return 0;
+}
+"""
+
+
+def alu_model(op, a, b, c_in, width):
+	# Vectorized reference for ALU(width). Returns (result, z, c, n) as uint64 arrays.
+	if not MIN_WIDTH <= width <= MAX_WIDTH:
+		raise ValueError("Width must be between {} and {}, not {}".format(MIN_WIDTH, MAX_WIDTH, width))
+	mask = u64((1 << width) - 1)
+	msb = u64(width - 1)
+	def bit(x, i):
+		return (x >> u64(i)) & u64(1)
+	a = a.astype(u64) & mask
+	b = b.astype(u64) & mask
+	c_in = c_in.astype(u64) & u64(1)
+	result = np.zeros_like(a)
+	c = np.zeros_like(a)
+	for o in Op:
+		sel = (op == o.value)
+		if not sel.any():
+			continue
+		x, y, ci = a[sel], b[sel], c_in[sel]
+		cr = np.zeros_like(x)
+		if o in (Op.ADD, Op.ADC):
+			ci = ci if o == Op.ADC else np.zeros_like(x)
+			r = (x + y + ci) & mask
+			xm, ym = bit(x, msb), bit(y, msb)
+			cm = bit(r, msb) ^ xm ^ ym # Carry into the MSB
+			cr = (xm & ym) | (xm & cm) | (ym & cm)
+		elif o in (Op.SUB, Op.SBC):
+			ci = ci if o == Op.SBC else np.zeros_like(x)
+			r = (x - y - ci) & mask
+			cr = ((x < y) | ((x == y) & (ci == 1))).astype(u64)
+		elif o == Op.NOT:
+			r = ~x & mask
+		elif o == Op.AND:
+			r = x & y
+		elif o == Op.OR:
+			r = x | y
+		elif o == Op.XOR:
+			r = x ^ y
+		elif o == Op.SHL:
+			r, cr = (x << u64(1)) & mask, bit(x, msb)
+		elif o == Op.SHR:
+			r = x >> u64(1)
+		elif o == Op.ASL:
+			r, cr = ((x << u64(1)) | ci) & mask, bit(x, msb)
+		elif o == Op.ASR:
+			r, cr = (x >> u64(1)) | (ci << msb), bit(x, 0)
+		elif o == Op.SL4:
+			r, cr = (x << u64(4)) & mask, bit(x, width - 4)
+		elif o == Op.SL16:
+			r, cr = (x << u64(16)) & mask, bit(x, width - 16)
+		elif o == Op.SR4:
+			r, cr = x >> u64(4), bit(x, 3)
+		elif o == Op.SR16:
+			r, cr = x >> u64(16), bit(x, 15)
+		result[sel] = r
+		c[sel] = cr
+	return result, (result == 0).astype(u64), c, bit(result, msb)
+
+
+def corner_vectors(width):
+	# Every op and carry-in against all pairs of interesting operand values
+	mask = (1 << width) - 1
+	top = 1 << (width - 1)
+	values = np.array(sorted({0, 1, 2, 0xf, 0xffff, mask, mask - 1, top, top - 1, top + 1,
+			0x5555555555555555 & mask, 0xaaaaaaaaaaaaaaaa & mask}), dtype=u64)
+	op, a, b, c_in = np.meshgrid(np.arange(len(Op)), np.arange(len(values)), np.arange(len(values)), [0, 1], indexing="ij")
+	v = np.zeros(op.size, dtype=VECTOR)
+	v["op"], v["a"], v["b"], v["c_in"] = op.ravel(), values[a.ravel()], values[b.ravel()], c_in.ravel()
+	return v
+
+
+def random_vectors(n, width, rng):
+	mask = u64((1 << width) - 1)
+	v = np.zeros(n, dtype=VECTOR)
+	v["op"] = rng.integers(0, len(Op), n)
+	v["a"] = rng.integers(0, 1 << 64, n, dtype=u64, endpoint=False) & mask
+	v["b"] = rng.integers(0, 1 << 64, n, dtype=u64, endpoint=False) & mask
+	v["c_in"] = rng.integers(0, 2, n)
+	return v
+
+
+class ALUHarness(Elaboratable):
+	# Gives the ALU ports fixed names, so the C++ driver can refer to them.
+	def __init__(self, width):
+		self.alu = ALU(width)
+		self.a = Signal(width, name="a")
+		self.b = Signal(width, name="b")
+		self.op = Signal(4, name="op")
+		self.c_in = Signal(name="cin")
+		self.result = Signal(width, name="result")
+		self.z = Signal(name="z")
+		self.c = Signal(name="c")
+		self.n = Signal(name="n")
+
+	def ports(self):
+		return [self.a, self.b, self.op, self.c_in, self.result, self.z, self.c, self.n]
+
+	def elaborate(self, platform):
+		m = Module()
+		alu = self.alu
+		# Flatten the ALU, CXXRTL then builds the whole harness as one module.
+		m.submodules.alu = frag = Fragment.get(alu, platform)
+		frag.flatten = True
+		m.d.comb += [
+			alu.arg_a.eq(self.a),
+			alu.arg_b.eq(self.b),
+			alu.op.eq(self.op),
+			alu.c_in.eq(self.c_in),
+			self.result.eq(alu.result),
+			self.z.eq(alu.z),
+			self.c.eq(alu.c),
+			self.n.eq(alu.n)
+		]
+		return m
+
+
+class CxxrtlALU:
+	def __init__(self, width, cache):
+		self.width = width
+		self.cxx = os.environ.get("CXX", "c++")
+		yosys = find_yosys()
+		h = hashlib.sha256()
+		for fname in ["cpu.py", "alucheck.py"]:
+			with open(os.path.join(HERE, fname), "rb") as f:
+				h.update(f.read())
+		h.update("{} {} {} {}".format(width, metadata.version("amaranth"), yosys_version(yosys), self.cxx).encode())
+		if cache:
+			self.tmpdir = None
+			cache_dir = cache.path
+		else:
+			# Removed together with this object
+			self.tmpdir = tempfile.TemporaryDirectory()
+			cache_dir = self.tmpdir.name
+		self.binary = os.path.join(cache_dir, "alusim-" + h.hexdigest())
+		if os.path.exists(self.binary):
+			os.utime(self.binary)
+		else:
+			t0 = time.perf_counter()
+			os.makedirs(cache_dir, exist_ok=True)
+			self.build(yosys)
+			if cache:
+				cache.evict()
+			print("Built CXXRTL simulator for width {} in {:.1f} s".format(width, time.perf_counter() - t0))
+
+	def build(self, yosys):
+		h = ALUHarness(self.width)
+		il = rtlil.convert(h, ports=h.ports(), emit_src=False)
+		cc = yosys_convert(il, "cc")
+		inc = os.path.join(yosys.data_dir(), "include")
+		with tempfile.TemporaryDirectory() as tmp:
+			with open(os.path.join(tmp, "alu.cc"), "w") as f:
+				f.write(cc)
+			with open(os.path.join(tmp, "driver.cc"), "w") as f:
+				f.write(DRIVER)
+			out = os.path.join(tmp, "alusim")
+			subprocess.run([self.cxx, "-O2", "-std=c++14",
+					"-I", os.path.join(inc, "backends", "cxxrtl", "runtime"), "-I", inc,
+					os.path.join(tmp, "driver.cc"), "-o", out], check=True)
+			os.replace(out, self.binary)
+
+	def run(self, v):
+		with tempfile.TemporaryDirectory() as tmp:
+			fin, fout = os.path.join(tmp, "in"), os.path.join(tmp, "out")
+			v.tofile(fin)
+			subprocess.run([self.binary, fin, fout], check=True)
+			r = np.fromfile(fout, dtype=RESPONSE)
+		f = r["flags"].astype(u64)
+		return r["result"], f & 1, (f >> u64(1)) & 1, (f >> u64(2)) & 1
+
+
+class PysimALU:
+	def __init__(self, width):
+		self.width = width
+
+	def run(self, v):
+		from amaranth.sim import Simulator, Settle
+		h = ALUHarness(self.width)
+		out = np.zeros((4, len(v)), dtype=u64)
+		def process():
+			for i in range(len(v)):
+				yield h.a.eq(int(v["a"][i]))
+				yield h.b.eq(int(v["b"][i]))
+				yield h.op.eq(int(v["op"][i]))
+				yield h.c_in.eq(int(v["c_in"][i]))
+				yield Settle()
+				for j, s in enumerate([h.result, h.z, h.c, h.n]):
+					out[j, i] = yield s
+		sim = Simulator(h)
+		sim.add_process(process)
+		sim.run()
+		return tuple(out)
+
+
+def check(dut, width, nvectors, batch, rng, max_report=10):
+	t_dut = t_model = 0.0
+	done = errors = 0
+	corners = corner_vectors(width)
+	while done < nvectors:
+		if done == 0:
+			v = corners[:nvectors]
+		else:
+			v = random_vectors(min(batch, nvectors - done), width, rng)
+		t0 = time.perf_counter()
+		got = dut.run(v)
+		t1 = time.perf_counter()
+		exp = alu_model(v["op"], v["a"], v["b"], v["c_in"], width)
+		t2 = time.perf_counter()
+		t_dut += t1 - t0
+		t_model += t2 - t1
+		bad = np.zeros(len(v), dtype=bool)
+		for g, e in zip(got, exp):
+			bad |= (g != e)
+		for i in np.flatnonzero(bad):
+			if errors < max_report:
+				print("Mismatch: {} a={:x} b={:x} c_in={}: expected {:x} z={} c={} n={}, got {:x} z={} c={} n={}".format(
+						Op(v["op"][i]).name, v["a"][i], v["b"][i], v["c_in"][i],
+						*(int(x[i]) for x in exp), *(int(x[i]) for x in got)))
+			errors += 1
+		done += len(v)
+	print("Width {}: {} vectors, {} mismatches".format(width, done, errors))
+	print("  simulation: {:10.0f} vectors/s".format(done / max(t_dut, 1e-9)))
+	print("  model:      {:10.0f} vectors/s".format(done / max(t_model, 1e-9)))
+	return errors
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Randomized ALU conformance test against a NumPy model")
+	parser.add_argument("--width", type=int, nargs="+", default=[32], metavar="N", help="ALU widths to test (default: 32)")
+	parser.add_argument("--vectors", type=int, default=1000000, help="number of test vectors per width")
+	parser.add_argument("--batch", type=int, default=1 << 20, help="vectors per simulator run")
+	parser.add_argument("--seed", type=int, default=None)
+	parser.add_argument("--backend", choices=["cxxrtl", "pysim"], default="cxxrtl")
+	add_cache_arguments(parser)
+	args = parser.parse_args()
+	for width in args.width:
+		if not MIN_WIDTH <= width <= MAX_WIDTH:
+			parser.error("unsupported width {}, only widths from {} to {} bits can be tested".format(
+					width, MIN_WIDTH, MAX_WIDTH))
+
+	rng = np.random.default_rng(args.seed)
+	cache = cache_from_args(args)
+	errors = 0
+	for width in args.width:
+		if args.backend == "cxxrtl":
+			dut = CxxrtlALU(width, cache)
+		else:
+			dut = PysimALU(width)
+		errors += check(dut, width, args.vectors, args.batch, rng)
+	sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -158,15 +158,25 @@ class WbMaster(Record):
 	def __init__(self, dw, aw):
 		super().__init__(WbMasterLayout(dw, aw))
 
-State = Enum("State", "RESET FETCH DECODE EXECUTE LOAD STORE IRQ RTI", start=0)
+State = Enum("State", "RESET FETCH DECODE EXECUTE LOAD STORE IRQ OPERAND", start=0)
 
 Opcode = Enum("Opcode", "alu alui ldi ldis ldb ldh ldw ldiu stb sth stw nop b bdec jsr ext", start=0)
 
 class Cpu(Elaboratable):
-	def __init__(self, width=32, nregs=16):
+	def __init__(self, width=32, nregs=16, bus_width=None, addr_width=None, registered_operands=False):
 		self.width = w = width
 		self.nregs = nr = nregs
-		self.bus = WbMaster(w, w) # FIXME: Address width separately?
+		# Register ALU operands and load/store addresses in an extra OPERAND cycle after DECODE,
+		# instead of computing them combinationally from the register file in EXECUTE.
+		self.registered_operands = registered_operands
+		self.bus_width = dw = bus_width or w
+		self.addr_width = aw = addr_width or w
+		if dw < w or dw % w or dw & (dw - 1):
+			raise ValueError("Bus width must be a power of two multiple of {}, not {}".format(w, dw))
+		self.word_log2 = (w // 8).bit_length() - 1 # log2 of bytes per register/instruction
+		self.lanes_log2 = (dw // 8).bit_length() - 1 # log2 of byte lanes on the data bus
+		self.ipl = dw // w # Instructions per bus access
+		self.bus = WbMaster(dw, aw)
 		self.irq = Signal(4)
 		self.irqack = Signal(4)
 		self.alu = ALU(w)
@@ -209,6 +219,12 @@ class Cpu(Elaboratable):
 		self.n_reg = Signal()
 		self.z_reg = Signal()
 		self.i_reg = Signal()
+		# Fetch buffer: Holds the last fetched bus word, so that a bus wider than
+		# one instruction can supply the following instructions without a new access.
+		self.fbuf = Signal(dw)
+		self.fbuf_adr = Signal(w - self.lanes_log2)
+		self.fbuf_valid = Signal()
+		self.fbuf_hit = Signal()
 
 	def ports(self):
 		return [self.bus.adr_o, self.bus.dat_o, self.bus.stb_o, self.bus.we_o, self.bus.sel_o,
@@ -223,11 +239,7 @@ class Cpu(Elaboratable):
 		c = m.d.comb
 		c += [
 			Cat(self.imm8, self.Rs2, self.alu.op, self.Rs1, self.Rd, self.cond, self.opc).eq(self.ir),
-			self.load_addr.eq(self.Rr[self.Rs1] + self.imm16),
-			self.store_addr.eq(self.Rr[self.Rd] + self.imm16),
 			self.ls_size.eq(self.opc[:2]),
-			self.alu.arg_a.eq(self.Rr[self.Rs1]),
-			self.alu.arg_b.eq(Mux(self.opc == 0, self.Rr[self.Rs2], self.imm12)),
 			self.alu.c_in.eq(self.c_reg),
 			self.imm12.eq(self.ir),
 			self.imm16.eq(self.ir),
@@ -238,6 +250,8 @@ class Cpu(Elaboratable):
 			self.nextirq.eq(Mux(self.irqreg[0], 1, Mux(self.irqreg[1], 2, Mux(self.irqreg[2], 4, 8))))
 		]
 		s = m.d.sync
+		if not self.registered_operands:
+			self.cpu_operand(m, c, w)
 		with m.If(self.bus.rst_i):
 			s += self.state.eq(State.RESET)
 		with m.Else():
@@ -252,6 +266,10 @@ class Cpu(Elaboratable):
 				self.cpu_fetch(m, s, w)
 			with m.Case(State.DECODE):
 				self.cpu_decode(m, s, w)
+			if self.registered_operands:
+				with m.Case(State.OPERAND):
+					self.cpu_operand(m, s, w)
+					s += self.state.eq(State.EXECUTE)
 			with m.Case(State.EXECUTE):
 				self.cpu_execute(m, s, w)
 			with m.Case(State.LOAD):
@@ -278,9 +296,29 @@ class Cpu(Elaboratable):
 			self.irqack.eq(0),
 			self.irqreg.eq(0)
 		]
+		if self.ipl > 1:
+			s += [
+				self.fbuf_valid.eq(0),
+				self.fbuf_hit.eq(0)
+			]
 
 	def cpu_fetch(self, m, s, w):
-		with m.If(self.irqreg.any() & ~self.irqmode & ~self.i_reg):
+		take_irq = self.irqreg.any() & ~self.irqmode & ~self.i_reg
+		if self.ipl > 1:
+			lb = self.lanes_log2
+			with m.If(~take_irq & self.fbuf_valid & (self.fbuf_adr == self.next_pc[lb:])):
+				# Next instruction is already in the fetch buffer, skip the bus cycle.
+				s += self.pc.eq(self.next_pc)
+				s += self.fbuf_hit.eq(1)
+				s += self.state.eq(State.DECODE)
+			with m.Else():
+				s += self.fbuf_hit.eq(0)
+				self._fetch_bus(m, s, take_irq)
+		else:
+			self._fetch_bus(m, s, take_irq)
+
+	def _fetch_bus(self, m, s, take_irq):
+		with m.If(take_irq):
 			# IRQ
 			s += self.irqack.eq(self.nextirq)
 			s += self.bus.adr_o.eq(self.irqaddr << 3)
@@ -296,31 +334,49 @@ class Cpu(Elaboratable):
 		s += self.bus.sel_o.eq(~0) # All ones
 		s += self.bus.stb_o.eq(1)
 		with m.If(self.bus.ack_i):
-			with m.If(self.irqreg.any() & ~self.irqmode & ~self.i_reg):
+			with m.If(take_irq):
 				s += self.irqmode.eq(1)
 			s += self.state.eq(State.DECODE)
 
 	def cpu_decode(self, m, s, w):
+		ex = State.OPERAND if self.registered_operands else State.EXECUTE
 		s += self.irqreg.eq(self.irq)
 		s += self.irqack.eq(0)
-		s += self.ir.eq(self.bus.dat_i)
+		if self.ipl > 1:
+			lb = self.lanes_log2
+			line = Mux(self.fbuf_hit, self.fbuf, self.bus.dat_i)
+			s += self.ir.eq(line.word_select(self.pc[self.word_log2:lb], w))
+			with m.If(~self.fbuf_hit):
+				s += self.fbuf.eq(self.bus.dat_i)
+				s += self.fbuf_adr.eq(self.pc[lb:])
+				s += self.fbuf_valid.eq(1)
+		else:
+			s += self.ir.eq(self.bus.dat_i)
 		s += self.bus.stb_o.eq(0)
 		s += self.next_pc.eq(self.pc + 4)
 		with m.Switch(self.cond):
 			with m.Case("100-"):
-				s += self.state.eq(Mux(self.z_reg == self.cond[0], State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(self.z_reg == self.cond[0], ex, State.FETCH))
 			with m.Case("1110"):
-				s += self.state.eq(Mux(self.n_reg & ~self.z_reg, State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(self.n_reg & ~self.z_reg, ex, State.FETCH))
 			with m.Case("1100"):
-				s += self.state.eq(Mux(~self.n_reg & ~self.z_reg, State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(~self.n_reg & ~self.z_reg, ex, State.FETCH))
 			with m.Case("1111"):
-				s += self.state.eq(Mux(self.n_reg | self.z_reg, State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(self.n_reg | self.z_reg, ex, State.FETCH))
 			with m.Case("1101"):
-				s += self.state.eq(Mux(~self.n_reg | self.z_reg, State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(~self.n_reg | self.z_reg, ex, State.FETCH))
 			with m.Case("101-"):
-				s += self.state.eq(Mux(self.c_reg == self.cond[0], State.EXECUTE, State.FETCH))
+				s += self.state.eq(Mux(self.c_reg == self.cond[0], ex, State.FETCH))
 			with m.Default():
-				s += self.state.eq(State.EXECUTE)
+				s += self.state.eq(ex)
+
+	def cpu_operand(self, m, d, w):
+		d += [
+			self.load_addr.eq(self.Rr[self.Rs1] + self.imm16),
+			self.store_addr.eq(self.Rr[self.Rd] + self.imm16),
+			self.alu.arg_a.eq(self.Rr[self.Rs1]),
+			self.alu.arg_b.eq(Mux(self.opc == 0, self.Rr[self.Rs2], self.imm12))
+		]
 
 	def cpu_execute(self, m, s, w):
 		with m.Switch(self.opc):
@@ -354,12 +410,15 @@ class Cpu(Elaboratable):
 				self._set_sel_o(m, s, self.store_addr)
 				with m.Switch(self.ls_size):
 					with m.Case(0):
-						bs = self.store_addr[:2] << 3
-						s += self.bus.dat_o.eq((self.Rr[self.Rs1] & 0xff) << bs)
+						s += self.bus.dat_o.eq(self.Rr[self.Rs1][:8] << self._lane_shift(self.store_addr, 0))
 					with m.Case(1):
-						s += self.bus.dat_o.eq(Mux(self.store_addr[1], self.Rr[self.Rs1] << 16, self.Rr[self.Rs1] & 0xffff))
+						s += self.bus.dat_o.eq(self.Rr[self.Rs1][:16] << self._lane_shift(self.store_addr, 1))
 					with m.Default():
-						s += self.bus.dat_o.eq(self.Rr[self.Rs1])
+						s += self.bus.dat_o.eq(self.Rr[self.Rs1] << self._lane_shift(self.store_addr, self.word_log2))
+				if self.ipl > 1:
+					# Keep the fetch buffer coherent with self-modifying code.
+					with m.If(self.store_addr[self.lanes_log2:] == self.fbuf_adr):
+						s += self.fbuf_valid.eq(0)
 				s += self.bus.stb_o.eq(1)
 				with m.If(self.bus.ack_i):
 					with m.If(self.Rs1 == -3): # Rr[-3] == sp
@@ -392,27 +451,40 @@ class Cpu(Elaboratable):
 			with m.Default():
 				s += self.state.eq(State.FETCH)
 
+	def _lane_index(self, addr, size):
+		# Index of the naturally aligned 2**size byte slot within the bus word addressed by addr.
+		return addr[size:self.lanes_log2]
+
+	def _lane_shift(self, addr, size):
+		# Bit offset of a 2**size byte access within the bus word addressed by addr.
+		if size >= self.lanes_log2:
+			return 0
+		return self._lane_index(addr, size) << (size + 3)
+
+	def _sel_mask(self, addr, size):
+		mask = (1 << (1 << size)) - 1
+		if size >= self.lanes_log2:
+			return mask
+		return mask << (self._lane_index(addr, size) << size)
+
 	def _set_sel_o(self, m, s, addr):
-		# FIXME: This function needs to be parametrized for different bus widths.
 		with m.Switch(self.ls_size):
 			with m.Case(0):
-				s += self.bus.sel_o.eq(1 << addr[:2])
+				s += self.bus.sel_o.eq(self._sel_mask(addr, 0))
 			with m.Case(1):
-				s += self.bus.sel_o.eq(3 << addr[1])
+				s += self.bus.sel_o.eq(self._sel_mask(addr, 1))
 			with m.Default():
-				s += self.bus.sel_o.eq(~0)
+				s += self.bus.sel_o.eq(self._sel_mask(addr, self.word_log2))
 
 	def cpu_load(self, m, s, w):
-		# FIXME: This function needs to be parametrized for different bus widths.
 		s += self.bus.stb_o.eq(0)
 		with m.Switch(self.ls_size):
 			with m.Case(0):
-				bs = self.load_addr[:2] << 3
-				s += self.Rr[self.Rd].eq((self.bus.dat_i >> bs) & 0xff)
+				s += self.Rr[self.Rd].eq((self.bus.dat_i >> self._lane_shift(self.load_addr, 0))[:8])
 			with m.Case(1):
-				s += self.Rr[self.Rd].eq(Mux(self.load_addr[1], self.bus.dat_i[16:], self.bus.dat_i[:16]))
+				s += self.Rr[self.Rd].eq((self.bus.dat_i >> self._lane_shift(self.load_addr, 1))[:16])
 			with m.Default():
-				s += self.Rr[self.Rd].eq(self.bus.dat_i)
+				s += self.Rr[self.Rd].eq((self.bus.dat_i >> self._lane_shift(self.load_addr, self.word_log2))[:w])
 		s += self.state.eq(State.FETCH)
 
 	def cpu_store(self, m, s, w):
@@ -427,49 +499,84 @@ class Cpu(Elaboratable):
 		return m, cpu.ports()
 
 
-if __name__ == "__main__":
-	simulate = ("--sim" in sys.argv)
-	if simulate:
-		from assemble import Cpuv2Assembler
-		mem = []
-		class Assemble2Mem(Cpuv2Assembler):
-			def emit(self, emit):
-				if isinstance(emit, list):
-					mem.extend(emit)
+def load_program(fname):
+	from assemble import Cpuv2Assembler
+	mem = []
+	class Assemble2Mem(Cpuv2Assembler):
+		def emit(self, emit):
+			if isinstance(emit, list):
+				mem.extend(emit)
+			else:
+				mem.append(emit)
+	Assemble2Mem(fname)
+	return {a:v for a, v, in enumerate(mem)}
+
+def simulate(cpu, mem, cycles, vcd=None, verbose=True):
+	# Memory is a dict of 32-bit words, the bus model splits/merges them into bus words.
+	top = Module()
+	top.submodules.cpu = cpu
+	top.d.comb += cpu.bus.ack_i.eq(cpu.bus.stb_o)
+	wpl = cpu.bus_width // 32
+	stats = {"cycles": cycles, "fetches": 0, "instructions": 0}
+	def process():
+		for i in range(cycles):
+			stb = yield cpu.bus.stb_o
+			we = yield cpu.bus.we_o
+			adr = (yield cpu.bus.adr_o) // (cpu.bus_width // 8) * wpl
+			sel = yield cpu.bus.sel_o
+			state = yield cpu.state
+			if state == State.DECODE.value:
+				stats["instructions"] += 1
+			if stb:
+				if we:
+					do = yield cpu.bus.dat_o
+					for j in range(wpl):
+						msk = 0
+						for b in range(4):
+							msk |= 0xff << (8 * b) if sel & (1 << (4 * j + b)) else 0
+						if not msk:
+							continue
+						d = (do >> (32 * j)) & 0xffffffff
+						mem[adr + j] = (mem.get(adr + j, 0) & ~msk) | (d & msk)
+						if verbose:
+							print("Mem write addr {:08x} = {:08x}".format((adr + j) * 4, mem[adr + j]))
 				else:
-					mem.append(emit)
-		a = Assemble2Mem("monitor.s")
-		mem = {a:v for a, v, in enumerate(mem)}
-		top = Module()
-		top.submodules.cpu = cpu = Cpu(32, 16)
-		top.d.comb += cpu.bus.ack_i.eq(cpu.bus.stb_o)
-		print("Simulating...")
-		def process():
-			for i in range(300):
-				stb = yield cpu.bus.stb_o
-				we = yield cpu.bus.we_o
-				adr = yield cpu.bus.adr_o // 4
-				sel = yield cpu.bus.sel_o
-				if stb:
-					if we:
-						msk = 0xff if sel & 1 else 0
-						msk |= 0xff00 if sel & 2 else 0
-						msk |= 0xff0000 if sel & 4 else 0
-						msk |= 0xff000000 if sel & 8 else 0
-						mem[adr] = (mem.get(adr, 0) & ~msk) | ((yield cpu.bus.dat_o) & msk)
-						print("Mem write addr {:08x} = {:08x}".format(adr * 4, mem[adr]))
-					else:
-						if not adr in mem:
-							do = 0x00213200
-						else:
-							do = mem[adr]
-						yield cpu.bus.dat_i.eq(do)
-				yield
-		sim = Simulator(top)
-		sim.add_clock(1e-7)
-		sim.add_sync_process(process)
-		with sim.write_vcd("test.vcd", "test.gtkw", traces=cpu.ports()):
+					if state == State.FETCH.value:
+						stats["fetches"] += 1
+					do = 0
+					for j in range(wpl):
+						do |= mem.get(adr + j, 0x00213200) << (32 * j)
+					yield cpu.bus.dat_i.eq(do)
+			yield
+	sim = Simulator(top)
+	sim.add_clock(1e-7)
+	sim.add_sync_process(process)
+	if vcd:
+		with sim.write_vcd(vcd + ".vcd", vcd + ".gtkw", traces=cpu.ports()):
 			sim.run()
+	else:
+		sim.run()
+	return stats
+
+
+if __name__ == "__main__":
+	if "--sim" in sys.argv or "--bench" in sys.argv:
+		import argparse
+		parser = argparse.ArgumentParser()
+		parser.add_argument("--sim", action="store_true", help="simulate monitor.s and write test.vcd")
+		parser.add_argument("--bench", action="store_true", help="compare fetch bus cycles for 32/64/128 bit buses")
+		parser.add_argument("--bus-width", type=int, default=32)
+		parser.add_argument("--cycles", type=int, default=300)
+		args = parser.parse_args()
+		if args.bench:
+			print("{:>9} {:>8} {:>8} {:>12} {:>8}".format("bus width", "cycles", "fetches", "instructions", "CPI"))
+			for dw in (32, 64, 128):
+				st = simulate(Cpu(32, 16, bus_width=dw), load_program("monitor.s"), args.cycles, verbose=False)
+				print("{:>9} {:>8} {:>8} {:>12} {:>8.2f}".format(dw, st["cycles"], st["fetches"],
+						st["instructions"], st["cycles"] / max(st["instructions"], 1)))
+		else:
+			print("Simulating...")
+			simulate(Cpu(32, 16, bus_width=args.bus_width), load_program("monitor.s"), args.cycles, vcd="test")
 	else:
 		parser = main_parser()
 		args = parser.parse_args()
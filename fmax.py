@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Fmax and resource usage of Cpu configurations, using yosys and nextpnr.
+#
+# Every combination of the given parameter values is synthesized and placed and routed
+# for an iCE40 or ECP5 device. The netlists come from the netlist.py cache.
+#
+import os
+import sys
+import json
+import argparse
+import itertools
+import subprocess
+import tempfile
+
+from netlist import HERE, CPU_PARAMS, get_netlist, add_cache_arguments, cache_from_args
+
+TARGETS = {
+	# The ECP5 build is done out-of-context, so the bus ports don't need to fit on IO pins.
+	# The iCE40 build places all ports on pins, which only fits with a 32-bit bus.
+	"ecp5": ("synth_ecp5", ["nextpnr-ecp5", "--85k", "--package", "CABGA381", "--out-of-context"]),
+	"ice40": ("synth_ice40", ["nextpnr-ice40", "--hx8k", "--package", "ct256"]),
+}
+
+
+class BuildError(Exception):
+	pass
+
+
+def run(cmd, logfile):
+	with open(logfile, "w") as log:
+		try:
+			ret = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+		except FileNotFoundError:
+			print("{} not found, is it installed and in PATH?".format(cmd[0]), file=sys.stderr)
+			sys.exit(1)
+	if ret.returncode:
+		with open(logfile, "r") as log:
+			tail = log.readlines()[-5:]
+		raise BuildError("{} failed:\n{}".format(cmd[0], "".join("    " + l for l in tail).rstrip()))
+
+
+def implement(il, target, freq, workdir):
+	synth, pnr = TARGETS[target]
+	ilfile = os.path.join(workdir, "top.il")
+	jsonfile = os.path.join(workdir, "top.json")
+	report = os.path.join(workdir, "report.json")
+	with open(ilfile, "w") as f:
+		f.write(il)
+	run(["yosys", "-q", "-p", "read_rtlil {}; {} -top top -json {}".format(ilfile, synth, jsonfile)],
+			os.path.join(workdir, "yosys.log"))
+	run(pnr + ["--json", jsonfile, "--freq", str(freq), "--report", report],
+			os.path.join(workdir, "nextpnr.log"))
+	with open(report, "r") as f:
+		return json.load(f)
+
+
+def cpi(params, cycles):
+	from cpu import Cpu, simulate, load_program
+	st = simulate(Cpu(**params), load_program(os.path.join(HERE, "monitor.s")), cycles, verbose=False)
+	return st["cycles"] / max(st["instructions"], 1)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Report Fmax and resource use for Cpu configurations")
+	for p, default in CPU_PARAMS.items():
+		parser.add_argument("--" + p.replace("_", "-"), type=int, nargs="+", default=[default],
+				metavar="N", help="one or more values to sweep (default: {})".format(default))
+	parser.add_argument("--target", choices=TARGETS.keys(), default="ecp5")
+	parser.add_argument("--freq", type=float, default=50, help="target frequency in MHz (default: 50)")
+	parser.add_argument("--cpi", type=int, metavar="CYCLES", default=0,
+			help="also simulate monitor.s for CYCLES cycles and report CPI and MIPS")
+	parser.add_argument("--keep", help="keep the build files in this directory")
+	add_cache_arguments(parser)
+	args = parser.parse_args()
+
+	cache = cache_from_args(args)
+	names = list(CPU_PARAMS)
+	failed = 0
+	for values in itertools.product(*(getattr(args, p) for p in names)):
+		params = dict(zip(names, values))
+		for p, default in CPU_PARAMS.items():
+			if isinstance(default, bool):
+				params[p] = bool(params[p])
+		print(" ".join("{}={}".format(p, v) for p, v in params.items()))
+		try:
+			il = get_netlist(params, "il", cache, emit_src=False)
+			if args.keep:
+				workdir = os.path.join(args.keep, "_".join("{}{}".format(p, v) for p, v in params.items()))
+				os.makedirs(workdir, exist_ok=True)
+				rep = implement(il, args.target, args.freq, workdir)
+			else:
+				with tempfile.TemporaryDirectory() as workdir:
+					rep = implement(il, args.target, args.freq, workdir)
+		except (BuildError, ValueError) as e: # ValueError: invalid parameter combination
+			print("  {}".format(e))
+			failed += 1
+			continue
+		fmax = min((c["achieved"] for c in rep.get("fmax", {}).values()), default=None)
+		if fmax is None:
+			print("  Fmax: n/a")
+		else:
+			print("  Fmax: {:.2f} MHz".format(fmax))
+		if args.cpi:
+			c = cpi(params, args.cpi)
+			if fmax is None:
+				print("  CPI: {:.2f}".format(c))
+			else:
+				print("  CPI: {:.2f}, {:.2f} MIPS".format(c, fmax / c))
+		for bel, u in sorted(rep["utilization"].items()):
+			if u["used"]:
+				print("  {:<16} {:>6}/{:<6}".format(bel, u["used"], u["available"]))
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#
+# Cached netlist generation for the Cpu core.
+#
+# The output of a generation run only depends on the Cpu constructor parameters, the
+# output type, the design sources and the amaranth (and for Verilog/CXXRTL, yosys) version,
+# so all of those are hashed into a key and the result is kept in an on-disk cache. An RTLIL
+# cache hit does not import amaranth at all.
+#
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+from importlib import metadata
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCES = ["cpu.py", "netlist.py"]
+
+# Cpu constructor keyword arguments and their defaults
+CPU_PARAMS = {
+	"width": 32,
+	"nregs": 16,
+	"bus_width": None,
+	"addr_width": None,
+	"registered_operands": False,
+}
+
+TYPES = {
+	"il": ".il",
+	"v": ".v",
+	"cc": ".cc",
+}
+
+# Yosys commands turning RTLIL into the other output types
+YOSYS_SCRIPTS = {
+	"v": ["proc -nomux", "memory_collect", "write_verilog -norename"],
+	"cc": ["write_cxxrtl"],
+}
+
+
+def find_yosys():
+	# amaranth has no public API for this, keep its use in this one place.
+	from amaranth._toolchain.yosys import find_yosys
+	return find_yosys(lambda ver: ver >= (0, 10))
+
+
+def yosys_version(yosys=None):
+	yosys = yosys or find_yosys()
+	return "{} {}".format(yosys.__name__, ".".join(str(v) for v in yosys.version()))
+
+
+def yosys_convert(il, gtype):
+	script = ["read_rtlil <<rtlil\n{}\nrtlil".format(il)] + YOSYS_SCRIPTS[gtype]
+	# write_verilog always warns about processes it can't translate, see amaranth.back.verilog
+	return find_yosys().run(["-q", "-"], "\n".join(script), ignore_warnings=True)
+
+
+def resolve_params(params):
+	# Fill in the defaults Cpu derives from other parameters, so equal netlists share a key.
+	params = dict(params)
+	params["bus_width"] = params["bus_width"] or params["width"]
+	params["addr_width"] = params["addr_width"] or params["width"]
+	return params
+
+
+class NetlistCache:
+	def __init__(self, path, max_size):
+		self.path = path
+		self.max_size = max_size
+
+	def key(self, params, gtype, name, emit_src):
+		h = hashlib.sha256()
+		for fname in SOURCES:
+			with open(os.path.join(HERE, fname), "rb") as f:
+				h.update(f.read())
+		try:
+			version = metadata.version("amaranth")
+		except metadata.PackageNotFoundError:
+			version = None
+		h.update(json.dumps({
+			"params": resolve_params(params),
+			"type": gtype,
+			"name": name,
+			"emit_src": emit_src,
+			"amaranth": version,
+			"yosys": yosys_version() if gtype in YOSYS_SCRIPTS else None
+		}, sort_keys=True).encode())
+		return h.hexdigest()
+
+	def _file(self, key, gtype):
+		return os.path.join(self.path, key + TYPES[gtype])
+
+	def get(self, key, gtype):
+		fname = self._file(key, gtype)
+		try:
+			with open(fname, "r") as f:
+				data = f.read()
+		except FileNotFoundError:
+			return None
+		os.utime(fname) # Mark as recently used
+		return data
+
+	def put(self, key, gtype, data):
+		os.makedirs(self.path, exist_ok=True)
+		fname = self._file(key, gtype)
+		tmp = "{}.{}.tmp".format(fname, os.getpid())
+		with open(tmp, "w") as f:
+			f.write(data)
+		os.replace(tmp, fname)
+		self.evict()
+
+	def evict(self):
+		# Remove least recently used entries until the cache fits in max_size bytes.
+		entries = []
+		for e in os.scandir(self.path):
+			if e.is_file() and not e.name.endswith(".tmp"):
+				st = e.stat()
+				entries.append((st.st_mtime, st.st_size, e.path))
+		entries.sort()
+		total = sum(e[1] for e in entries)
+		for _, size, fname in entries:
+			if total <= self.max_size:
+				break
+			os.unlink(fname)
+			total -= size
+
+
+class StageTimer:
+	def __init__(self):
+		self.stages = []
+
+	def __call__(self, stage):
+		self.stage = stage
+		return self
+
+	def __enter__(self):
+		self.t0 = time.perf_counter()
+
+	def __exit__(self, *exc):
+		self.stages.append((self.stage, time.perf_counter() - self.t0))
+
+	def report(self, f=sys.stderr):
+		for stage, t in self.stages:
+			print("{:>10}: {:8.3f} s".format(stage, t), file=f)
+		print("{:>10}: {:8.3f} s".format("total", sum(t for _, t in self.stages)), file=f)
+
+
+def generate(params, gtype, name="top", emit_src=True, timer=None):
+	timer = timer or StageTimer()
+	with timer("import"):
+		from amaranth.hdl.ir import Fragment
+		from amaranth.back import rtlil
+		from cpu import Cpu
+	with timer("elaborate"):
+		cpu = Cpu(**params)
+		fragment = Fragment.get(cpu, None)
+	with timer("prepare"):
+		fragment = fragment.prepare(ports=cpu.ports())
+	with timer("rtlil"):
+		output, _ = rtlil.convert_fragment(fragment, name=name, emit_src=emit_src)
+	if gtype in YOSYS_SCRIPTS:
+		with timer("yosys"):
+			output = yosys_convert(output, gtype)
+	return output
+
+
+def get_netlist(params, gtype, cache=None, name="top", emit_src=True, timer=None, on_hit=None):
+	timer = timer or StageTimer()
+	output = None
+	if cache is not None:
+		with timer("lookup"):
+			key = cache.key(params, gtype, name, emit_src)
+			output = cache.get(key, gtype)
+		if output is not None and on_hit:
+			on_hit(key)
+	if output is None:
+		output = generate(params, gtype, name, emit_src, timer)
+		if cache is not None:
+			with timer("store"):
+				cache.put(key, gtype, output)
+	return output
+
+
+def add_cache_arguments(parser):
+	parser.add_argument("--cache-dir", default=os.path.join(HERE, ".netlist_cache"))
+	parser.add_argument("--cache-size", type=int, default=256, help="cache size limit in MiB (default: 256)")
+	parser.add_argument("--no-cache", action="store_true", help="always regenerate")
+
+
+def cache_from_args(args):
+	if args.no_cache:
+		return None
+	return NetlistCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Generate a Cpu netlist, reusing cached results")
+	for p, default in CPU_PARAMS.items():
+		if isinstance(default, bool):
+			parser.add_argument("--" + p.replace("_", "-"), action="store_true")
+		else:
+			parser.add_argument("--" + p.replace("_", "-"), type=int, default=default)
+	parser.add_argument("-t", "--type", choices=TYPES.keys(), default="il", help="output type (default: il)")
+	parser.add_argument("-o", "--output", help="output file (default: stdout)")
+	parser.add_argument("--name", default="top", help="top level module name")
+	parser.add_argument("--no-src", action="store_true", help="do not emit source locations")
+	add_cache_arguments(parser)
+	parser.add_argument("-q", "--quiet", action="store_true", help="do not report stage timing")
+	args = parser.parse_args()
+
+	sys.path.insert(0, HERE)
+	params = {p: getattr(args, p) for p in CPU_PARAMS}
+	timer = StageTimer()
+	def on_hit(key):
+		if not args.quiet:
+			print("cache hit: {}".format(key[:16]), file=sys.stderr)
+	output = get_netlist(params, args.type, cache_from_args(args), args.name, not args.no_src, timer, on_hit)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(output)
+	else:
+		print(output)
+	if not args.quiet:
+		timer.report()
+
+
+if __name__ == "__main__":
+	main()